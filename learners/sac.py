@@ -11,6 +11,7 @@ import logging
 
 import numpy as np
 
+from policy import flatten_grads
 from preprocessor import Preprocessor
 from utils.misc import TimerStat
 
@@ -27,6 +28,7 @@ class SACLearner(object):
 
     def __init__(self, policy_cls, args):
         self.args = args
+        assert self.args.double_Q
         self.batch_size = self.args.replay_batch_size
         self.policy_with_value = policy_cls(**vars(self.args))
         self.batch_data = {}
@@ -71,13 +73,12 @@ class SACLearner(object):
 
         act_tp1, logp_tp1 = self.policy_with_value.compute_action(processed_obs_tp1)
 
-        target_Q1_of_tp1 = self.policy_with_value.compute_Q1_target(processed_obs_tp1, act_tp1).numpy()
-        target_Q2_of_tp1 = self.policy_with_value.compute_Q2_target(processed_obs_tp1, act_tp1).numpy()
+        target_Qs_of_tp1 = self.policy_with_value.compute_Q_targets(processed_obs_tp1, act_tp1).numpy()
 
         alpha = self.tf.exp(self.policy_with_value.log_alpha).numpy() if self.args.alpha == 'auto' else self.args.alpha
 
         clipped_double_q_target = processed_rewards + self.args.gamma * \
-                                  (np.minimum(target_Q1_of_tp1, target_Q2_of_tp1)-alpha*logp_tp1.numpy())
+                                  (np.min(target_Qs_of_tp1, axis=0)-alpha*logp_tp1.numpy())
         return clipped_double_q_target
 
     def compute_td_error(self):
@@ -103,17 +104,18 @@ class SACLearner(object):
     @tf.function
     def q_forward_and_backward(self, mb_obs, mb_actions, mb_targets):
         processed_mb_obs = self.preprocessor.tf_process_obses(mb_obs)
-        with self.tf.GradientTape(persistent=True) as tape:
+        with self.tf.GradientTape() as tape:
             with self.tf.name_scope('q_loss') as scope:
-                q_pred1 = self.policy_with_value.compute_Q1(processed_mb_obs, mb_actions)
-                q_loss1 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred1 - mb_targets))
-
-                q_pred2 = self.policy_with_value.compute_Q2(processed_mb_obs, mb_actions)
-                q_loss2 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred2 - mb_targets))
+                q_preds = self.policy_with_value.compute_Qs(processed_mb_obs, mb_actions)
+                q_losses = 0.5 * self.tf.reduce_mean(self.tf.square(q_preds - mb_targets), axis=1)
+                q_loss1, q_loss2 = q_losses[0], q_losses[1]
 
         with self.tf.name_scope('q_gradient') as scope:
-            q_gradient1 = tape.gradient(q_loss1, self.policy_with_value.Q1.trainable_weights)
-            q_gradient2 = tape.gradient(q_loss2, self.policy_with_value.Q2.trainable_weights)
+            # each loss depends on its own network only, so one backward pass over their sum
+            # yields both gradients
+            q_gradient1, q_gradient2 = tape.gradient(self.tf.reduce_sum(q_losses),
+                                                     [self.policy_with_value.Q1.trainable_weights,
+                                                      self.policy_with_value.Q2.trainable_weights])
 
         return q_loss1, q_loss2, q_gradient1, q_gradient2
 
@@ -122,9 +124,7 @@ class SACLearner(object):
         with self.tf.GradientTape() as tape:
             processed_obses = self.preprocessor.tf_process_obses(mb_obs)
             actions, logps = self.policy_with_value.compute_action(processed_obses)
-            all_Qs1 = self.policy_with_value.compute_Q1(processed_obses, actions)
-            all_Qs2 = self.policy_with_value.compute_Q2(processed_obses, actions)
-            all_Qs_min = self.tf.reduce_min((all_Qs1, all_Qs2), 0)
+            all_Qs_min = self.tf.reduce_min(self.policy_with_value.compute_Qs(processed_obses, actions), axis=0)
             alpha = self.tf.exp(self.policy_with_value.log_alpha) if self.args.alpha == 'auto' else self.args.alpha
             policy_loss = self.tf.reduce_mean(alpha*logps-all_Qs_min)
 
@@ -217,7 +217,7 @@ class SACLearner(object):
             gradient_tensor = q_gradient1 + q_gradient2 + policy_gradient + alpha_gradient
         else:
             gradient_tensor = q_gradient1 + q_gradient2 + policy_gradient
-        return list(map(lambda x: x.numpy(), gradient_tensor))
+        return flatten_grads(gradient_tensor)
 
 class SACLearnerWithCost(object):
     import tensorflow as tf
@@ -227,6 +227,7 @@ class SACLearnerWithCost(object):
 
     def __init__(self, policy_cls, args):
         self.args = args
+        assert self.args.double_Q
         if isinstance(self.args.random_seed, int):
             self.set_seed(self.args.random_seed)
         self.batch_size = self.args.replay_batch_size
@@ -284,15 +285,14 @@ class SACLearnerWithCost(object):
 
         act_tp1, logp_tp1 = self.policy_with_value.compute_action(processed_obs_tp1)
 
-        target_Q1_of_tp1 = self.policy_with_value.compute_Q1_target(processed_obs_tp1, act_tp1).numpy()
-        target_Q2_of_tp1 = self.policy_with_value.compute_Q2_target(processed_obs_tp1, act_tp1).numpy()
+        target_Qs_of_tp1 = self.policy_with_value.compute_Q_targets(processed_obs_tp1, act_tp1).numpy()
         target_QC1_of_tp1 = self.policy_with_value.compute_QC1_target(processed_obs_tp1, act_tp1).numpy()
 
 
         alpha = self.tf.exp(self.policy_with_value.log_alpha).numpy() if self.args.alpha == 'auto' else self.args.alpha
 
         clipped_double_q_target = processed_rewards + self.args.gamma * \
-                                  (np.minimum(target_Q1_of_tp1, target_Q2_of_tp1)-alpha*logp_tp1.numpy())
+                                  (np.min(target_Qs_of_tp1, axis=0)-alpha*logp_tp1.numpy())
         if self.args.mlp_lam:
             processed_cost = self.compute_delta_safety_index()
             clipped_double_qc_target = np.clip(processed_cost, -0.001, np.inf)
@@ -353,28 +353,31 @@ class SACLearnerWithCost(object):
     @tf.function
     def q_forward_and_backward(self, mb_obs, mb_actions, mb_targets, mb_cost_targets):
         processed_mb_obs = self.preprocessor.tf_process_obses(mb_obs)
-        with self.tf.GradientTape(persistent=True) as tape:
+        with self.tf.GradientTape() as tape:
             with self.tf.name_scope('q_loss') as scope:
-                q_pred1 = self.policy_with_value.compute_Q1(processed_mb_obs, mb_actions)
-                q_loss1 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred1 - mb_targets))
-
-                q_pred2 = self.policy_with_value.compute_Q2(processed_mb_obs, mb_actions)
-                q_loss2 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred2 - mb_targets))
+                q_preds = self.policy_with_value.compute_Qs(processed_mb_obs, mb_actions)
+                q_losses = 0.5 * self.tf.reduce_mean(self.tf.square(q_preds - mb_targets), axis=1)
+                q_loss1, q_loss2 = q_losses[0], q_losses[1]
 
                 qc_pred1 = self.policy_with_value.compute_QC1(processed_mb_obs, mb_actions)
                 qc_loss1 = 0.5 * self.tf.reduce_mean(self.tf.square(qc_pred1 - mb_cost_targets))
+                total_loss = self.tf.reduce_sum(q_losses) + qc_loss1
                 if self.args.double_QC:
                     qc_pred2 = self.policy_with_value.compute_QC2(processed_mb_obs, mb_actions)
                     qc_loss2 = 0.5 * self.tf.reduce_mean(self.tf.square(qc_pred2 - mb_cost_targets))
+                    total_loss += qc_loss2
 
         with self.tf.name_scope('q_gradient') as scope:
-            q_gradient1 = tape.gradient(q_loss1, self.policy_with_value.Q1.trainable_weights)
-            q_gradient2 = tape.gradient(q_loss2, self.policy_with_value.Q2.trainable_weights)
-            qc_gradient1 = tape.gradient(qc_loss1, self.policy_with_value.QC1.trainable_weights)
+            models = [self.policy_with_value.Q1, self.policy_with_value.Q2, self.policy_with_value.QC1]
+            if self.args.double_QC:
+                models.append(self.policy_with_value.QC2)
+            gradients = tape.gradient(total_loss, [model.trainable_weights for model in models])
             if self.args.double_QC:
-                qc_gradient2 = tape.gradient(qc_loss2, self.policy_with_value.QC2.trainable_weights)
+                q_gradient1, q_gradient2, qc_gradient1, qc_gradient2 = gradients
+            else:
+                q_gradient1, q_gradient2, qc_gradient1 = gradients
 
-        distributions_stats = dict(qc1_vals=qc_pred1,q1_vals=q_pred1, q2_vals=q_pred2)
+        distributions_stats = dict(qc1_vals=qc_pred1, q1_vals=q_preds[0], q2_vals=q_preds[1])
 
         if self.args.double_QC:
             distributions_stats.update(dict(qc2_vals=qc_pred2))
@@ -389,9 +392,7 @@ class SACLearnerWithCost(object):
         with self.tf.GradientTape() as tape:
             processed_obses = self.preprocessor.tf_process_obses(mb_obs)
             actions, logps = self.policy_with_value.compute_action(processed_obses)
-            all_Qs1 = self.policy_with_value.compute_Q1(processed_obses, actions)
-            all_Qs2 = self.policy_with_value.compute_Q2(processed_obses, actions)
-            all_Qs_min = self.tf.reduce_min((all_Qs1, all_Qs2), 0)
+            all_Qs_min = self.tf.reduce_min(self.policy_with_value.compute_Qs(processed_obses, actions), axis=0)
             alpha = self.tf.exp(self.policy_with_value.log_alpha) if self.args.alpha == 'auto' else self.args.alpha
             if self.args.double_QC:
                 QC1 = self.policy_with_value.compute_QC1(processed_obses, actions)
@@ -436,9 +437,7 @@ class SACLearnerWithCost(object):
         with self.tf.GradientTape() as tape:
             processed_obses = self.preprocessor.tf_process_obses(mb_obs)
             actions, logps = self.policy_with_value.compute_action(processed_obses)
-            all_Qs1 = self.policy_with_value.compute_Q1(processed_obses, actions)
-            all_Qs2 = self.policy_with_value.compute_Q2(processed_obses, actions)
-            all_Qs_min = self.tf.reduce_min((all_Qs1, all_Qs2), 0)
+            all_Qs_min = self.tf.reduce_min(self.policy_with_value.compute_Qs(processed_obses, actions), axis=0)
             alpha = self.tf.exp(self.policy_with_value.log_alpha) if self.args.alpha == 'auto' else self.args.alpha
             # lams = self.policy_with_value.compute_lam(processed_obses)
             if self.args.double_QC:
@@ -489,8 +488,7 @@ class SACLearnerWithCost(object):
             else:
                 QC1 = self.policy_with_value.compute_QC1(processed_obses, mb_actions)
                 violation = QC1 - self.args.cost_lim
-            violation_count = self.tf.where(QC1 > self.args.cost_lim, self.tf.ones_like(QC1), self.tf.zeros_like(QC1))
-            violation_rate = self.tf.reduce_sum(violation_count) / self.args.replay_batch_size
+            violation_rate = self.tf.reduce_mean(self.tf.cast(QC1 > self.args.cost_lim, self.tf.float32))
             if self.args.mlp_lam:
                 lams = self.policy_with_value.compute_lam(processed_obses)
                 lams = self.tf.clip_by_value(lams, 0, 100)
@@ -540,7 +538,7 @@ class SACLearnerWithCost(object):
             phi_tp1 = self.tf.reduce_max(phi_tp1, axis=1)
             delta_phi = phi_tp1 - phi_t
 
-            sis_paras_loss = self.tf.reduce_mean(self.tf.where(delta_phi > 0, delta_phi, self.tf.zeros_like(delta_phi)))
+            sis_paras_loss = self.tf.reduce_mean(self.tf.nn.relu(delta_phi))
 
         with self.tf.name_scope('sis_paras_gradient') as scope:
             sis_paras_gradient = tape.gradient(sis_paras_loss, self.policy_with_value.sis_para.trainable_weights)
@@ -684,7 +682,7 @@ class SACLearnerWithCost(object):
             gradient_tensor = q_gradient1 + q_gradient2 + qc_gradient1 + qc_gradient2 \
                               + policy_gradient + lam_gradient + sis_paras_gradient
 
-        return list(map(lambda x: x.numpy(), gradient_tensor))
+        return flatten_grads(gradient_tensor)
 
 
 if __name__ == '__main__':
@@ -11,6 +11,7 @@ import logging
 
 import numpy as np
 
+from policy import flatten_grads
 from preprocessor import Preprocessor
 from utils.misc import TimerStat
 
@@ -26,6 +27,7 @@ class TD3Learner(object):
 
     def __init__(self, policy_cls, args):
         self.args = args
+        assert self.args.double_Q
         self.batch_size = self.args.replay_batch_size
         self.policy_with_value = policy_cls(**vars(self.args))
         self.batch_data = {}
@@ -75,9 +77,8 @@ class TD3Learner(object):
                                                 -self.args.policy_smoothing_clip,
                                                 self.args.policy_smoothing_clip)
 
-        target_Q1_of_tp1 = self.policy_with_value.compute_Q1_target(processed_obs_tp1, target_act_tp1).numpy()
-        target_Q2_of_tp1 = self.policy_with_value.compute_Q2_target(processed_obs_tp1, target_act_tp1).numpy()
-        clipped_double_q_target = processed_rewards + self.args.gamma * np.minimum(target_Q1_of_tp1, target_Q2_of_tp1)
+        target_Qs_of_tp1 = self.policy_with_value.compute_Q_targets(processed_obs_tp1, target_act_tp1).numpy()
+        clipped_double_q_target = processed_rewards + self.args.gamma * np.min(target_Qs_of_tp1, axis=0)
         return clipped_double_q_target
 
     def compute_td_error(self):
@@ -103,17 +104,16 @@ class TD3Learner(object):
     @tf.function
     def q_forward_and_backward(self, mb_obs, mb_actions, mb_targets):
         processed_mb_obs = self.preprocessor.tf_process_obses(mb_obs)
-        with self.tf.GradientTape(persistent=True) as tape:
+        with self.tf.GradientTape() as tape:
             with self.tf.name_scope('q_loss') as scope:
-                q_pred1 = self.policy_with_value.compute_Q1(processed_mb_obs, mb_actions)
-                q_loss1 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred1 - mb_targets))
-
-                q_pred2 = self.policy_with_value.compute_Q2(processed_mb_obs, mb_actions)
-                q_loss2 = 0.5 * self.tf.reduce_mean(self.tf.square(q_pred2 - mb_targets))
+                q_preds = self.policy_with_value.compute_Qs(processed_mb_obs, mb_actions)
+                q_losses = 0.5 * self.tf.reduce_mean(self.tf.square(q_preds - mb_targets), axis=1)
+                q_loss1, q_loss2 = q_losses[0], q_losses[1]
 
         with self.tf.name_scope('q_gradient') as scope:
-            q_gradient1 = tape.gradient(q_loss1, self.policy_with_value.Q1.trainable_weights)
-            q_gradient2 = tape.gradient(q_loss2, self.policy_with_value.Q2.trainable_weights)
+            q_gradient1, q_gradient2 = tape.gradient(self.tf.reduce_sum(q_losses),
+                                                     [self.policy_with_value.Q1.trainable_weights,
+                                                      self.policy_with_value.Q2.trainable_weights])
 
         return q_loss1, q_loss2, q_gradient1, q_gradient2
 
@@ -122,9 +122,7 @@ class TD3Learner(object):
         with self.tf.GradientTape() as tape:
             processed_obses = self.preprocessor.tf_process_obses(mb_obs)
             actions, _ = self.policy_with_value.compute_action(processed_obses)
-            all_Qs1 = self.policy_with_value.compute_Q1(processed_obses, actions)
-            all_Qs2 = self.policy_with_value.compute_Q2(processed_obses, actions)
-            all_Qs_min = self.tf.reduce_min((all_Qs1, all_Qs2), 0)
+            all_Qs_min = self.tf.reduce_min(self.policy_with_value.compute_Qs(processed_obses, actions), axis=0)
             policy_loss = -self.tf.reduce_mean(all_Qs_min)
             value_var = self.tf.math.reduce_variance(all_Qs_min)
             value_mean = -policy_loss
@@ -185,7 +183,7 @@ class TD3Learner(object):
         ))
 
         gradient_tensor = q_gradient1 + q_gradient2 + final_policy_gradient  # q_gradient + final_policy_gradient
-        return list(map(lambda x: x.numpy(), gradient_tensor))
+        return flatten_grads(gradient_tensor)
 
 
 if __name__ == '__main__':
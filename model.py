@@ -20,14 +20,20 @@ tf.config.threading.set_intra_op_parallelism_threads(1)
 class MLPNet(Model):
     def __init__(self, input_dim, num_hidden_layers, num_hidden_units, hidden_activation, output_dim, **kwargs):
         super(MLPNet, self).__init__(name=kwargs['name'])
+        # hidden layers may run under a mixed precision policy such as 'mixed_bfloat16';
+        # the output layer always computes in float32 to keep logits and values in full range
+        hidden_dtype = kwargs.get('dtype_policy') or 'float32'
+        if hidden_dtype not in ('float32', 'mixed_bfloat16'):
+            # float16 would need loss scaling in every optimizer to keep gradients from underflowing
+            raise ValueError('unsupported dtype_policy {}'.format(hidden_dtype))
         self.first_ = Dense(num_hidden_units,
                             activation=hidden_activation,
                             kernel_initializer=tf.keras.initializers.Orthogonal(np.sqrt(2.)),
-                            dtype=tf.float32)
+                            dtype=hidden_dtype)
         self.hidden = Sequential([Dense(num_hidden_units,
                                         activation=hidden_activation,
                                         kernel_initializer=tf.keras.initializers.Orthogonal(np.sqrt(2.)),
-                                        dtype=tf.float32) for _ in range(num_hidden_layers-1)])
+                                        dtype=hidden_dtype) for _ in range(num_hidden_layers-1)])
         output_activation = kwargs['output_activation'] if kwargs.get('output_activation') else 'linear'
         if kwargs.get('output_bias'):
             self.outputs = Dense(output_dim,
@@ -49,6 +55,37 @@ class MLPNet(Model):
         x = self.outputs(x)
         return x
 
+    @property
+    def dense_layers(self):
+        return [self.first_] + self.hidden.layers + [self.outputs]
+
+
+def ensemble_forward(models, *inputs):
+    """Run several MLPNets on the same input and stack their outputs.
+
+    The networks are evaluated one after another with their own weights; this is not a batched
+    kernel, it only gives callers every network's output from one call. Several inputs are
+    treated as their concatenation along the last axis: the first-layer kernel is split
+    row-wise instead, so the concatenated tensor is never materialized. The first layer
+    computes in its own compute dtype, as the Dense layer would under a mixed precision policy.
+    The output has shape [len(models), batch_size, output_dim].
+    """
+    outputs = []
+    for model in models:
+        first, *layers = model.dense_layers
+        dtype = first.compute_dtype
+        kernel = tf.cast(first.kernel, dtype)
+        x, start = tf.cast(first.bias, dtype), 0
+        for inp in inputs:
+            end = start + inp.shape[-1]
+            x += tf.matmul(tf.cast(inp, dtype), kernel[start:end])
+            start = end
+        x = first.activation(x)
+        for layer in layers:
+            x = layer(x)
+        outputs.append(x)
+    return tf.stack(outputs)
+
 
 class AlphaModel(Model):
     def __init__(self, **kwargs):
@@ -108,7 +145,7 @@ def test_attrib():
 
     a = Variable(0, name='d')
 
-    p = MLPNet(2, 2, 128, 1, name='ttt')
+    p = MLPNet(2, 2, 128, 'elu', 1, name='ttt')
     print(hasattr(p, 'get_weights'))
     print(hasattr(p, 'trainable_weights'))
     print(hasattr(a, 'get_weights'))
@@ -126,7 +163,7 @@ def test_attrib():
 
 
 def test_clone():
-    p = MLPNet(2, 2, 128, 1, name='ttt')
+    p = MLPNet(2, 2, 128, 'elu', 1, name='ttt')
     print(p._is_graph_network)
     s = tf.keras.models.clone_model(p)
     print(s)
@@ -134,7 +171,7 @@ def test_clone():
 
 def test_out():
     import numpy as np
-    Qs = tuple(MLPNet(8, 2, 128, 1, name='Q' + str(i)) for i in range(2))
+    Qs = tuple(MLPNet(8, 2, 128, 'elu', 1, name='Q' + str(i)) for i in range(2))
     inp = np.random.random((128, 8))
     out = [Q(inp) for Q in Qs]
     print(out)
@@ -142,7 +179,7 @@ def test_out():
 
 def test_memory():
     import time
-    Q = MLPNet(8, 2, 128, 1)
+    Q = MLPNet(8, 2, 128, 'elu', 1, name='Q')
     time.sleep(111111)
 
 
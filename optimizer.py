@@ -268,11 +268,11 @@ class OffPolicyAsyncOptimizer(object):
         with self.timers['learning_timer']:
             for learner, objID in self.learn_tasks.completed():
                 grads = ray.get(objID)
-                learner_stats = ray.get(learner.get_stats.remote())
+                # queue the stats calls ahead of the next gradient task and only block on them afterwards,
+                # so the learner starts its next backward pass while the driver is still waiting here
+                learner_stats_id = learner.get_stats.remote()
                 if self.args.buffer_type == 'priority':
-                    info_for_buffer = ray.get(learner.get_info_for_buffer.remote())
-                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
-                                                                   info_for_buffer['td_error'])
+                    info_for_buffer_id = learner.get_info_for_buffer.remote()
                 rb, samples = self.learner_queue.get(block=False)
                 if ppc_params and \
                         (self.args.obs_ptype == 'normalize' or self.args.rew_ptype == 'normalize'):
@@ -283,6 +283,11 @@ class OffPolicyAsyncOptimizer(object):
                 learner.set_weights.remote(weights)
                 self.learn_tasks.add(learner, learner.compute_gradient.remote(samples[:-1], rb, samples[-1],
                                                                               self.local_worker.iteration))
+                learner_stats = ray.get(learner_stats_id)
+                if self.args.buffer_type == 'priority':
+                    info_for_buffer = ray.get(info_for_buffer_id)
+                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
+                                                                   info_for_buffer['td_error'])
                 if self.update_thread.inqueue.full():
                     self.num_grads_dropped += 1
                 self.update_thread.inqueue.put([grads, learner_stats])
@@ -443,15 +448,9 @@ class OffPolicyAsyncOptimizerWithCost(object):
         with self.timers['learning_timer']:
             for learner, objID in self.learn_tasks.completed():
                 grads = ray.get(objID)
-                learner_stats = ray.get(learner.get_stats.remote())
-                if self.args.buffer_type == 'priority':
-                    info_for_buffer = ray.get(learner.get_info_for_buffer.remote())
-                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
-                                                                   info_for_buffer['td_error'])
-                if self.args.buffer_type == 'priority_cost':
-                    info_for_buffer = ray.get(learner.get_info_for_buffer.remote())
-                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
-                                                                   info_for_buffer['cost_td_error'])
+                learner_stats_id = learner.get_stats.remote()
+                if self.args.buffer_type in ('priority', 'priority_cost'):
+                    info_for_buffer_id = learner.get_info_for_buffer.remote()
                 rb, samples = self.learner_queue.get(block=False)
                 if ppc_params and \
                         (self.args.obs_ptype == 'normalize' or self.args.rew_ptype == 'normalize'):
@@ -462,6 +461,15 @@ class OffPolicyAsyncOptimizerWithCost(object):
                 learner.set_weights.remote(weights)
                 self.learn_tasks.add(learner, learner.compute_gradient.remote(samples[:-1], rb, samples[-1],
                                                                               self.local_worker.iteration))
+                learner_stats = ray.get(learner_stats_id)
+                if self.args.buffer_type == 'priority':
+                    info_for_buffer = ray.get(info_for_buffer_id)
+                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
+                                                                   info_for_buffer['td_error'])
+                if self.args.buffer_type == 'priority_cost':
+                    info_for_buffer = ray.get(info_for_buffer_id)
+                    info_for_buffer['rb'].update_priorities.remote(info_for_buffer['indexes'],
+                                                                   info_for_buffer['cost_td_error'])
                 if self.update_thread.inqueue.full():
                     self.num_grads_dropped += 1
                 self.update_thread.inqueue.put([grads, learner_stats])
@@ -557,9 +565,9 @@ class SingleProcessOffPolicyOptimizer(object):
         # apply grad
         with self.timers['grad_apply_timer']:
             try:
-                judge_is_nan(grads)
+                judge_is_nan(grads if isinstance(grads, list) else [grads])
             except ValueError:
-                grads = [tf.zeros_like(grad) for grad in grads]
+                grads = [tf.zeros_like(grad) for grad in grads] if isinstance(grads, list) else np.zeros_like(grads)
                 logger.info('Grad is nan!, zero it')
             self.worker.apply_gradients(self.iteration, grads)
 
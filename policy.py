@@ -8,23 +8,50 @@
 # =====================================
 
 import tensorflow as tf
+import tensorflow_probability as tfp
 import numpy as np
+from functools import partial
 from tensorflow.keras.optimizers.schedules import PolynomialDecay
 
-from model import MLPNet, AlphaModel, LamModel, SiSParaModel
+from model import MLPNet, AlphaModel, LamModel, SiSParaModel, ensemble_forward
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
 
 NAME2MODELCLS = dict([('MLP', MLPNet),])
+LOG_STD_MIN, LOG_STD_MAX = -5., 1.
 
 
-class PolicyWithQs(tf.Module):
-    import tensorflow as tf
-    import tensorflow_probability as tfp
-    tfd = tfp.distributions
-    tfb = tfp.bijectors
-    tf.config.experimental.set_visible_devices([], 'GPU')
-    tf.config.threading.set_inter_op_parallelism_threads(1)
-    tf.config.threading.set_intra_op_parallelism_threads(1)
+def build_grad_slices(grad_layout):
+    # grad_layout lists (name, optimizer, var_list) in the order learners concatenate gradients;
+    # each entry is located both in a gradient list and in the flattened gradient vector
+    grad_slices, start, flat_start = {}, 0, 0
+    for name, optimizer, var_list in grad_layout:
+        sizes = [var.shape.num_elements() for var in var_list]
+        grad_slices[name] = (optimizer, tuple(var_list), start, start + len(var_list), flat_start, sizes)
+        start += len(var_list)
+        flat_start += sum(sizes)
+    return grad_slices
+
+
+def flatten_grads(grads):
+    # learners return their gradients as one float32 vector in grad_layout order, so each gradient
+    # crosses the object store as a single buffer; _apply_grads splits it back per variable
+    return tf.concat([tf.reshape(grad, [-1]) for grad in grads], axis=0).numpy()
+
+
+def hard_update(target_model, model):
+    # copy variable by variable so that no weights round-trip through numpy
+    for target, source in zip(target_model.weights, model.weights):
+        target.assign(source)
+
+
+def polyak_update(target, source, tau):
+    # applied through strategy.extended.update so that mirrored targets are updated on every replica
+    return target.assign(tau * source + (1.0 - tau) * target)
+
 
+class PolicyWithQs(tf.Module):
     def __init__(self, obs_dim, act_dim,
                  value_model_cls, value_num_hidden_layers, value_num_hidden_units,
                  value_hidden_activation, value_lr_schedule,
@@ -45,6 +72,8 @@ class PolicyWithQs(tf.Module):
 
         value_model_cls, policy_model_cls = NAME2MODELCLS[value_model_cls], \
                                             NAME2MODELCLS[policy_model_cls]
+        value_model_cls = partial(value_model_cls, dtype_policy=kwargs.get('dtype_policy'))
+        policy_model_cls = partial(policy_model_cls, dtype_policy=kwargs.get('dtype_policy'))
         self.policy = policy_model_cls(obs_dim, policy_num_hidden_layers, policy_num_hidden_units,
                                        policy_hidden_activation, act_dim * 2, name='policy',
                                        output_activation=policy_out_activation)
@@ -52,22 +81,24 @@ class PolicyWithQs(tf.Module):
                                               policy_hidden_activation, act_dim * 2, name='policy_target',
                                               output_activation=policy_out_activation)
         policy_lr = PolynomialDecay(*policy_lr_schedule)
-        self.policy_optimizer = self.tf.keras.optimizers.Adam(policy_lr, name='policy_adam_opt')
+        self.policy_optimizer = tf.keras.optimizers.Adam(policy_lr, name='policy_adam_opt')
 
         self.Q1 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                   value_hidden_activation, 1, name='Q1')
         self.Q1_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                          value_hidden_activation, 1, name='Q1_target')
-        self.Q1_target.set_weights(self.Q1.get_weights())
+        hard_update(self.Q1_target, self.Q1)
         value_lr = PolynomialDecay(*value_lr_schedule)
-        self.Q1_optimizer = self.tf.keras.optimizers.Adam(value_lr, name='Q1_adam_opt')
+        self.Q1_optimizer = tf.keras.optimizers.Adam(value_lr, name='Q1_adam_opt')
 
         self.Q2 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                   value_hidden_activation, 1, name='Q2')
         self.Q2_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                          value_hidden_activation, 1, name='Q2_target')
-        self.Q2_target.set_weights(self.Q2.get_weights())
-        self.Q2_optimizer = self.tf.keras.optimizers.Adam(value_lr, name='Q2_adam_opt')
+        hard_update(self.Q2_target, self.Q2)
+        self.Q2_optimizer = tf.keras.optimizers.Adam(value_lr, name='Q2_adam_opt')
+        self.Qs = (self.Q1, self.Q2,) if self.double_Q else (self.Q1,)
+        self.Q_targets = (self.Q1_target, self.Q2_target,) if self.double_Q else (self.Q1_target,)
 
         if self.policy_only:
             self.target_models = ()
@@ -88,171 +119,165 @@ class PolicyWithQs(tf.Module):
                 self.models = (self.Q1, self.policy,)
                 self.optimizers = (self.Q1_optimizer, self.policy_optimizer,)
 
+        # models and target_models are aligned, so zip pairs each network with its target
+        self.target_sync_ops = [(target, source)
+                                for model, target_model in zip(self.models, self.target_models)
+                                for source, target in zip(model.trainable_weights,
+                                                          target_model.trainable_weights)]
+
         if self.alpha == 'auto':
             self.alpha_model = AlphaModel(name='alpha')
-            alpha_lr = self.tf.keras.optimizers.schedules.PolynomialDecay(*alpha_lr_schedule)
-            self.alpha_optimizer = self.tf.keras.optimizers.Adam(alpha_lr, name='alpha_adam_opt')
+            alpha_lr = tf.keras.optimizers.schedules.PolynomialDecay(*alpha_lr_schedule)
+            self.alpha_optimizer = tf.keras.optimizers.Adam(alpha_lr, name='alpha_adam_opt')
             self.models += (self.alpha_model,)
             self.optimizers += (self.alpha_optimizer,)
 
-    def save_weights(self, save_dir, iteration):
+        self._grad_layout = [(model.name, optimizer, model.trainable_weights)
+                             for model, optimizer in zip(self.models, self.optimizers)]
+        self._grad_slices = build_grad_slices(self._grad_layout)
+        self._flat_weights = tuple(weight for model in self.models + self.target_models for weight in model.weights)
+        self._ckpt = self._build_ckpt()
+
+        # fixed signatures so that every batch size shares one trace; the deterministic
+        # forward passes and the target update are also XLA-compiled if jit_compile is set
+        jit_compile = kwargs.get('jit_compile', False)
+        obs_spec = tf.TensorSpec(shape=(None, obs_dim), dtype=tf.float32)
+        act_spec = tf.TensorSpec(shape=(None, act_dim), dtype=tf.float32)
+        for name in ('compute_action', 'compute_target_action'):
+            setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec]))
+        self.compute_mode = tf.function(self.compute_mode, input_signature=[obs_spec], jit_compile=jit_compile)
+        Q_fn_names = ('compute_Q1', 'compute_Q2', 'compute_Q1_target', 'compute_Q2_target',
+                      'compute_Qs', 'compute_Q_targets')
+        for name in Q_fn_names:
+            setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec, act_spec],
+                                            jit_compile=jit_compile))
+        self.update_targets = tf.function(self.update_targets, jit_compile=jit_compile)
+
+        # trace everything once here, so that the first sampling and training steps do not pay for it
+        for name in ('compute_action', 'compute_target_action', 'compute_mode', 'update_targets') + Q_fn_names:
+            getattr(self, name).get_concrete_function()
+
+    def _build_ckpt(self):
         model_pairs = [(model.name, model) for model in self.models]
         target_model_pairs = [(target_model.name, target_model) for target_model in self.target_models]
         optimizer_pairs = [(optimizer._name, optimizer) for optimizer in self.optimizers]
-        ckpt = self.tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
-        ckpt.save(save_dir + '/ckpt_ite' + str(iteration))
+        return tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
+
+    def save_weights(self, save_dir, iteration):
+        # write() keeps the '-1' suffix that a fresh Checkpoint.save() used to produce
+        self._ckpt.write(save_dir + '/ckpt_ite' + str(iteration) + '-1')
 
     def load_weights(self, load_dir, iteration):
-        model_pairs = [(model.name, model) for model in self.models]
-        target_model_pairs = [(target_model.name, target_model) for target_model in self.target_models]
-        optimizer_pairs = [(optimizer._name, optimizer) for optimizer in self.optimizers]
-        ckpt = self.tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
-        ckpt.restore(load_dir + '/ckpt_ite' + str(iteration) + '-1')
+        self._ckpt.restore(load_dir + '/ckpt_ite' + str(iteration) + '-1')
 
     def get_weights(self):
-        return [model.get_weights() for model in self.models] + \
-               [model.get_weights() for model in self.target_models]
+        return tf.keras.backend.batch_get_value(self._flat_weights)
 
     def set_weights(self, weights):
-        for i, weight in enumerate(weights):
-            if i < len(self.models):
-                self.models[i].set_weights(weight)
-            else:
-                self.target_models[i-len(self.models)].set_weights(weight)
+        tf.keras.backend.batch_set_value(zip(self._flat_weights, weights))
+
+    def _apply_grads(self, name, grads):
+        optimizer, var_list, start, end, flat_start, sizes = self._grad_slices[name]
+        if isinstance(grads, (list, tuple)):
+            grads = grads[start:end]
+        else:
+            grads = [tf.reshape(grad, var.shape) for grad, var in
+                     zip(tf.split(grads[flat_start:flat_start + sum(sizes)], sizes), var_list)]
+        optimizer.apply_gradients(zip(grads, var_list))
 
     @tf.function
     def apply_gradients(self, iteration, grads):
         if self.policy_only:
-            policy_grad = grads
-            self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
+            self._apply_grads('policy', grads)
         else:
             if self.double_Q:
-                q_weights_len = len(self.Q1.trainable_weights)
-                policy_weights_len = len(self.policy.trainable_weights)
-                q1_grad, q2_grad, policy_grad = grads[:q_weights_len], grads[q_weights_len:2*q_weights_len], \
-                                                grads[2*q_weights_len:2*q_weights_len+policy_weights_len]
-                self.Q1_optimizer.apply_gradients(zip(q1_grad, self.Q1.trainable_weights))
-                self.Q2_optimizer.apply_gradients(zip(q2_grad, self.Q2.trainable_weights))
+                self._apply_grads('Q1', grads)
+                self._apply_grads('Q2', grads)
                 if iteration % self.delay_update == 0:
-                    self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
-                    self.update_policy_target()
-                    self.update_Q1_target()
-                    self.update_Q2_target()
+                    self._apply_grads('policy', grads)
+                    self.update_targets()
                     if self.alpha == 'auto':
-                        alpha_grad = grads[-1:]
-                        self.alpha_optimizer.apply_gradients(zip(alpha_grad, self.alpha_model.trainable_weights))
+                        self._apply_grads('alpha', grads)
             else:
-                q_weights_len = len(self.Q1.trainable_weights)
-                policy_weights_len = len(self.policy.trainable_weights)
-                q1_grad, policy_grad = grads[:q_weights_len], grads[q_weights_len:q_weights_len+policy_weights_len]
-                self.Q1_optimizer.apply_gradients(zip(q1_grad, self.Q1.trainable_weights))
+                self._apply_grads('Q1', grads)
                 if iteration % self.delay_update == 0:
-                    self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
+                    self._apply_grads('policy', grads)
                     if self.alpha == 'auto':
-                        alpha_grad = grads[-1:]
-                        self.alpha_optimizer.apply_gradients(zip(alpha_grad, self.alpha_model.trainable_weights))
+                        self._apply_grads('alpha', grads)
                     if self.target:
-                        self.update_policy_target()
-                        self.update_Q1_target()
-
-    def update_Q1_target(self):
-        tau = self.tau
-        for source, target in zip(self.Q1.trainable_weights, self.Q1_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
+                        self.update_targets()
 
-    def update_Q2_target(self):
-        tau = self.tau
-        for source, target in zip(self.Q2.trainable_weights, self.Q2_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
+    def update_targets(self):
+        strategy = tf.distribute.get_strategy()
+        for target, source in self.target_sync_ops:
+            strategy.extended.update(target, polyak_update, args=(source, self.tau))
 
-    def update_policy_target(self):
-        tau = self.tau
-        for source, target in zip(self.policy.trainable_weights, self.policy_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
-
-    @tf.function
     def compute_mode(self, obs):
         logits = self.policy(obs)
-        mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-        return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean
+        mean, _ = tf.split(logits, num_or_size_splits=2, axis=-1)
+        return self.action_range * tf.tanh(mean) if self.action_range is not None else mean
 
     def _logits2dist(self, logits):
-        mean, log_std = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-        log_std = tf.clip_by_value(log_std, -5., 1.)
-        act_dist = self.tfd.MultivariateNormalDiag(mean, self.tf.exp(log_std))
+        mean, log_std = tf.split(logits, num_or_size_splits=2, axis=-1)
+        log_std = tf.clip_by_value(log_std, LOG_STD_MIN, LOG_STD_MAX)
+        act_dist = tfd.Independent(tfd.Normal(mean, tf.exp(log_std)), reinterpreted_batch_ndims=1)
         if self.action_range is not None:
-            act_dist = (
-                self.tfp.distributions.TransformedDistribution(
-                    distribution=act_dist,
-                    bijector=self.tfb.Chain(
-                        [self.tfb.Affine(scale_identity_multiplier=self.action_range),
-                         self.tfb.Tanh()])
-                ))
+            act_dist = tfd.TransformedDistribution(
+                distribution=act_dist,
+                bijector=tfb.Chain([tfb.Scale(self.action_range), tfb.Tanh()]))
         return act_dist
 
-    @tf.function
+    def _logits2action(self, logits):
+        if self.deterministic_policy:
+            mean, _ = tf.split(logits, num_or_size_splits=2, axis=-1)
+            return self.action_range * tf.tanh(mean) if self.action_range is not None else mean, 0.
+        else:
+            act_dist = self._logits2dist(logits)
+            actions = act_dist.sample()
+            logps = act_dist.log_prob(actions)
+            return actions, logps
+
     def compute_action(self, obs):
-        with self.tf.name_scope('compute_action') as scope:
-            logits = self.policy(obs)
-            if self.deterministic_policy:
-                mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-                return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean, 0.
-            else:
-                act_dist = self._logits2dist(logits)
-                actions = act_dist.sample()
-                logps = act_dist.log_prob(actions)
-                return actions, logps
+        with tf.name_scope('compute_action') as scope:
+            return self._logits2action(self.policy(obs))
 
-    @tf.function
     def compute_target_action(self, obs):
-        with self.tf.name_scope('compute_target_action') as scope:
-            logits = self.policy_target(obs)
-            if self.deterministic_policy:
-                mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-                return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean, 0.
-            else:
-                act_dist = self._logits2dist(logits)
-                actions = act_dist.sample()
-                logps = act_dist.log_prob(actions)
-                return actions, logps
+        with tf.name_scope('compute_target_action') as scope:
+            return self._logits2action(self.policy_target(obs))
 
-    @tf.function
     def compute_Q1(self, obs, act):
-        with self.tf.name_scope('compute_Q1') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q1') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q1(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q2(self, obs, act):
-        with self.tf.name_scope('compute_Q2') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q2') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q2(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q1_target(self, obs, act):
-        with self.tf.name_scope('compute_Q1_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q1_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q1_target(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q2_target(self, obs, act):
-        with self.tf.name_scope('compute_Q2_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q2_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q2_target(Q_inputs), axis=1)
 
+    def compute_Qs(self, obs, act):
+        with tf.name_scope('compute_Qs') as scope:
+            return tf.squeeze(ensemble_forward(self.Qs, obs, act), axis=-1)
+
+    def compute_Q_targets(self, obs, act):
+        with tf.name_scope('compute_Q_targets') as scope:
+            return tf.squeeze(ensemble_forward(self.Q_targets, obs, act), axis=-1)
+
     @property
     def log_alpha(self):
         return self.alpha_model.log_alpha
 
 class PolicyWithMu(tf.Module):
-    import tensorflow as tf
-    import tensorflow_probability as tfp
-    tfd = tfp.distributions
-    tfb = tfp.bijectors
-    tf.config.experimental.set_visible_devices([], 'GPU')
-    tf.config.threading.set_inter_op_parallelism_threads(1)
-    tf.config.threading.set_intra_op_parallelism_threads(1)
-
     def __init__(self, obs_dim, act_dim,
                  value_model_cls, value_num_hidden_layers, value_num_hidden_units,
                  value_hidden_activation, value_lr_schedule, cost_value_lr_schedule,
@@ -278,6 +303,8 @@ class PolicyWithMu(tf.Module):
 
         value_model_cls, policy_model_cls = NAME2MODELCLS[value_model_cls], \
                                             NAME2MODELCLS[policy_model_cls]
+        value_model_cls = partial(value_model_cls, dtype_policy=kwargs.get('dtype_policy'))
+        policy_model_cls = partial(policy_model_cls, dtype_policy=kwargs.get('dtype_policy'))
         self.policy = policy_model_cls(obs_dim, policy_num_hidden_layers, policy_num_hidden_units,
                                        policy_hidden_activation, act_dim * 2, name='policy',
                                        output_activation=policy_out_activation)
@@ -285,30 +312,32 @@ class PolicyWithMu(tf.Module):
                                               policy_hidden_activation, act_dim * 2, name='policy_target',
                                               output_activation=policy_out_activation)
         policy_lr = PolynomialDecay(*policy_lr_schedule)
-        self.policy_optimizer = self.tf.keras.optimizers.Adam(policy_lr, name='policy_adam_opt')
+        self.policy_optimizer = tf.keras.optimizers.Adam(policy_lr, name='policy_adam_opt')
 
         self.Q1 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                   value_hidden_activation, 1, name='Q1')
         self.Q1_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                          value_hidden_activation, 1, name='Q1_target')
-        self.Q1_target.set_weights(self.Q1.get_weights())
+        hard_update(self.Q1_target, self.Q1)
         value_lr = PolynomialDecay(*value_lr_schedule)
-        self.Q1_optimizer = self.tf.keras.optimizers.Adam(value_lr, name='Q1_adam_opt')
+        self.Q1_optimizer = tf.keras.optimizers.Adam(value_lr, name='Q1_adam_opt')
 
         self.Q2 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                   value_hidden_activation, 1, name='Q2')
         self.Q2_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                          value_hidden_activation, 1, name='Q2_target')
-        self.Q2_target.set_weights(self.Q2.get_weights())
-        self.Q2_optimizer = self.tf.keras.optimizers.Adam(value_lr, name='Q2_adam_opt')
+        hard_update(self.Q2_target, self.Q2)
+        self.Q2_optimizer = tf.keras.optimizers.Adam(value_lr, name='Q2_adam_opt')
+        self.Qs = (self.Q1, self.Q2,) if self.double_Q else (self.Q1,)
+        self.Q_targets = (self.Q1_target, self.Q2_target,) if self.double_Q else (self.Q1_target,)
 
         cost_value_lr = PolynomialDecay(*cost_value_lr_schedule)
         self.QC1 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                    value_hidden_activation, 1, name='QC1')
         self.QC1_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                           value_hidden_activation, 1, name='QC1_target')
-        self.QC1_target.set_weights(self.QC1.get_weights())
-        self.QC1_optimizer = self.tf.keras.optimizers.Adam(cost_value_lr, name='QC1_adam_opt')
+        hard_update(self.QC1_target, self.QC1)
+        self.QC1_optimizer = tf.keras.optimizers.Adam(cost_value_lr, name='QC1_adam_opt')
 
         if self.double_QC:
             self.QC2 = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
@@ -316,8 +345,8 @@ class PolicyWithMu(tf.Module):
             # output_bias=kwargs.get('cost_bias')
             self.QC2_target = value_model_cls(obs_dim + act_dim, value_num_hidden_layers, value_num_hidden_units,
                                              value_hidden_activation, 1, name='QC2_target')
-            self.QC2_target.set_weights(self.QC2.get_weights())
-            self.QC2_optimizer = self.tf.keras.optimizers.Adam(cost_value_lr, name='QC2_adam_opt')
+            hard_update(self.QC2_target, self.QC2)
+            self.QC2_optimizer = tf.keras.optimizers.Adam(cost_value_lr, name='QC2_adam_opt')
 
 
         if self.mlp_lam:
@@ -325,11 +354,11 @@ class PolicyWithMu(tf.Module):
             self.Lam = value_model_cls(obs_dim, value_num_hidden_layers, value_num_hidden_units,
                                        value_hidden_activation, 1,
                                        name='Lam', output_activation='softplus', output_bias=-10.)
-            self.Lam_optimizer = self.tf.keras.optimizers.Adam(lam_lr, name='lam_opt')
+            self.Lam_optimizer = tf.keras.optimizers.Adam(lam_lr, name='lam_opt')
         else:
             lam_lr = 3e-4
             self.Lam = LamModel(name='Lam')
-            self.Lam_optimizer = self.tf.keras.optimizers.Adam(lam_lr, name='lam_opt')
+            self.Lam_optimizer = tf.keras.optimizers.Adam(lam_lr, name='lam_opt')
 
 
 
@@ -361,216 +390,204 @@ class PolicyWithMu(tf.Module):
                 self.models = (self.Q1, self.policy,)
                 self.optimizers = (self.Q1_optimizer, self.policy_optimizer,)
 
+        # models and target_models are aligned, so zip pairs each network with its target
+        self.target_sync_ops = [(target, source)
+                                for model, target_model in zip(self.models, self.target_models)
+                                for source, target in zip(model.trainable_weights,
+                                                          target_model.trainable_weights)]
 
         if self.alpha == 'auto':
             self.alpha_model = AlphaModel(name='alpha')
-            alpha_lr = self.tf.keras.optimizers.schedules.PolynomialDecay(*alpha_lr_schedule)
-            self.alpha_optimizer = self.tf.keras.optimizers.Adam(alpha_lr, name='alpha_adam_opt')
+            alpha_lr = tf.keras.optimizers.schedules.PolynomialDecay(*alpha_lr_schedule)
+            self.alpha_optimizer = tf.keras.optimizers.Adam(alpha_lr, name='alpha_adam_opt')
             self.models += (self.alpha_model,)
             self.optimizers += (self.alpha_optimizer,)
 
-    def save_weights(self, save_dir, iteration):
+        self._grad_layout = [(model.name, optimizer, model.trainable_weights)
+                             for model, optimizer in zip(self.models, self.optimizers)]
+        if self.double_Q and not self.double_QC:
+            # learners pad the QC2 slot with a copy of the QC1 gradient
+            self._grad_layout.insert(3, ('QC2', None, self.QC1.trainable_weights))
+        self._grad_slices = build_grad_slices(self._grad_layout)
+        self._flat_weights = tuple(weight for model in self.models + self.target_models for weight in model.weights)
+        self._ckpt = self._build_ckpt()
+
+        # fixed signatures so that every batch size shares one trace; the deterministic
+        # forward passes and the target update are also XLA-compiled if jit_compile is set
+        jit_compile = kwargs.get('jit_compile', False)
+        obs_spec = tf.TensorSpec(shape=(None, obs_dim), dtype=tf.float32)
+        act_spec = tf.TensorSpec(shape=(None, act_dim), dtype=tf.float32)
+        for name in ('compute_action', 'compute_target_action'):
+            setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec]))
+        for name in ('compute_mode', 'compute_lam'):
+            setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec],
+                                            jit_compile=jit_compile))
+        Q_names = ('Q1', 'Q2', 'QC1', 'QC2') if self.double_QC else ('Q1', 'Q2', 'QC1')
+        for Q_name in Q_names:
+            for name in ('compute_' + Q_name, 'compute_' + Q_name + '_target'):
+                setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec, act_spec],
+                                                jit_compile=jit_compile))
+        for name in ('compute_Qs', 'compute_Q_targets'):
+            setattr(self, name, tf.function(getattr(self, name), input_signature=[obs_spec, act_spec],
+                                            jit_compile=jit_compile))
+        self.update_targets = tf.function(self.update_targets, jit_compile=jit_compile)
+
+        # trace everything once here, so that the first sampling and training steps do not pay for it;
+        # compute_lam only applies to the MLP multiplier
+        traced_names = ['compute_action', 'compute_target_action', 'compute_mode', 'update_targets',
+                        'compute_Qs', 'compute_Q_targets']
+        traced_names += ['compute_' + Q_name + suffix for Q_name in Q_names for suffix in ('', '_target')]
+        if self.mlp_lam:
+            traced_names.append('compute_lam')
+        for name in traced_names:
+            getattr(self, name).get_concrete_function()
+
+    def _build_ckpt(self):
         model_pairs = [(model.name, model) for model in self.models]
         target_model_pairs = [(target_model.name, target_model) for target_model in self.target_models]
         optimizer_pairs = [(optimizer._name, optimizer) for optimizer in self.optimizers]
-        ckpt = self.tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
-        ckpt.save(save_dir + '/ckpt_ite' + str(iteration))
+        return tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
+
+    def save_weights(self, save_dir, iteration):
+        # write() keeps the '-1' suffix that a fresh Checkpoint.save() used to produce
+        self._ckpt.write(save_dir + '/ckpt_ite' + str(iteration) + '-1')
 
     def load_weights(self, load_dir, iteration):
-        model_pairs = [(model.name, model) for model in self.models]
-        target_model_pairs = [(target_model.name, target_model) for target_model in self.target_models]
-        optimizer_pairs = [(optimizer._name, optimizer) for optimizer in self.optimizers]
-        ckpt = self.tf.train.Checkpoint(**dict(model_pairs + target_model_pairs + optimizer_pairs))
-        ckpt.restore(load_dir + '/ckpt_ite' + str(iteration) + '-1')
+        self._ckpt.restore(load_dir + '/ckpt_ite' + str(iteration) + '-1')
 
     def get_weights(self):
-        return [model.get_weights() for model in self.models] + \
-               [model.get_weights() for model in self.target_models]
+        return tf.keras.backend.batch_get_value(self._flat_weights)
 
     def set_weights(self, weights):
-        for i, weight in enumerate(weights):
-            if i < len(self.models):
-                self.models[i].set_weights(weight)
-            else:
-                self.target_models[i-len(self.models)].set_weights(weight)
+        tf.keras.backend.batch_set_value(zip(self._flat_weights, weights))
+
+    def _apply_grads(self, name, grads):
+        optimizer, var_list, start, end, flat_start, sizes = self._grad_slices[name]
+        if isinstance(grads, (list, tuple)):
+            grads = grads[start:end]
+        else:
+            grads = [tf.reshape(grad, var.shape) for grad, var in
+                     zip(tf.split(grads[flat_start:flat_start + sum(sizes)], sizes), var_list)]
+        optimizer.apply_gradients(zip(grads, var_list))
 
     @tf.function
     def apply_gradients(self, iteration, grads):
         if self.policy_only:
-            policy_grad = grads
-            self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
+            self._apply_grads('policy', grads)
         else:
             if self.double_Q:
-                q_weights_len = len(self.Q1.trainable_weights)
-                policy_weights_len = len(self.policy.trainable_weights)
-                lam_weights_len = len(self.Lam.trainable_weights)
-                q1_grad, q2_grad, qc1_grad, qc2_grad, policy_grad =\
-                    grads[:q_weights_len], \
-                    grads[q_weights_len:2*q_weights_len],\
-                    grads[2*q_weights_len:3*q_weights_len], \
-                    grads[3 * q_weights_len:4 * q_weights_len], \
-                    grads[4 * q_weights_len:4 * q_weights_len + policy_weights_len]
-                self.Q1_optimizer.apply_gradients(zip(q1_grad, self.Q1.trainable_weights))
-                self.Q2_optimizer.apply_gradients(zip(q2_grad, self.Q2.trainable_weights))
-                self.QC1_optimizer.apply_gradients(zip(qc1_grad, self.QC1.trainable_weights))
+                self._apply_grads('Q1', grads)
+                self._apply_grads('Q2', grads)
+                self._apply_grads('QC1', grads)
                 if self.double_QC:
-                    self.QC2_optimizer.apply_gradients(zip(qc2_grad, self.QC2.trainable_weights))
+                    self._apply_grads('QC2', grads)
                 if iteration % self.dual_ascent_interval == 0 and self.constrained and iteration > self.penalty_start:
-                    lam_grad = grads[4 * q_weights_len + policy_weights_len: 4 * q_weights_len + policy_weights_len + lam_weights_len]
-                    self.Lam_optimizer.apply_gradients(zip(lam_grad, self.Lam.trainable_weights))
+                    self._apply_grads('Lam', grads)
                 if iteration % self.delay_update == 0:
-                    self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
-                    self.update_policy_target()
-                    self.update_all_Q_target()
+                    self._apply_grads('policy', grads)
+                    self.update_targets()
                     if self.alpha == 'auto':
-                        alpha_grad = grads[-1:]
-                        self.alpha_optimizer.apply_gradients(zip(alpha_grad, self.alpha_model.trainable_weights))
+                        self._apply_grads('alpha', grads)
             else:
-                q_weights_len = len(self.Q1.trainable_weights)
-                policy_weights_len = len(self.policy.trainable_weights)
-                q1_grad, policy_grad = grads[:q_weights_len], grads[q_weights_len:q_weights_len+policy_weights_len]
-                self.Q1_optimizer.apply_gradients(zip(q1_grad, self.Q1.trainable_weights))
+                self._apply_grads('Q1', grads)
                 if iteration % self.delay_update == 0:
-                    self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
+                    self._apply_grads('policy', grads)
                     if self.alpha == 'auto':
-                        alpha_grad = grads[-1:]
-                        self.alpha_optimizer.apply_gradients(zip(alpha_grad, self.alpha_model.trainable_weights))
+                        self._apply_grads('alpha', grads)
                     if self.target:
-                        self.update_policy_target()
-                        self.update_Q1_target()
-
-    def update_all_Q_target(self):
-        self.update_Q1_target()
-        self.update_Q2_target()
-        self.update_QC1_target()
-        if self.double_QC:
-            self.update_QC2_target()
-
-    def update_Q1_target(self):
-        tau = self.tau
-        for source, target in zip(self.Q1.trainable_weights, self.Q1_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
-
-    def update_Q2_target(self):
-        tau = self.tau
-        for source, target in zip(self.Q2.trainable_weights, self.Q2_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
-
-    def update_QC1_target(self):
-        tau = self.tau
-        for source, target in zip(self.QC1.trainable_weights, self.QC1_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
-
-    def update_QC2_target(self):
-        tau = self.tau
-        for source, target in zip(self.QC2.trainable_weights, self.QC2_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
+                        self.update_targets()
 
-    def update_policy_target(self):
-        tau = self.tau
-        for source, target in zip(self.policy.trainable_weights, self.policy_target.trainable_weights):
-            target.assign(tau * source + (1.0 - tau) * target)
+    def update_targets(self):
+        strategy = tf.distribute.get_strategy()
+        for target, source in self.target_sync_ops:
+            strategy.extended.update(target, polyak_update, args=(source, self.tau))
 
-    @tf.function
     def compute_mode(self, obs):
         logits = self.policy(obs)
-        mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-        return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean
+        mean, _ = tf.split(logits, num_or_size_splits=2, axis=-1)
+        return self.action_range * tf.tanh(mean) if self.action_range is not None else mean
 
     def _logits2dist(self, logits):
-        mean, log_std = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-        log_std = tf.clip_by_value(log_std, -5., 1.)
-        act_dist = self.tfd.MultivariateNormalDiag(mean, self.tf.exp(log_std))
+        mean, log_std = tf.split(logits, num_or_size_splits=2, axis=-1)
+        log_std = tf.clip_by_value(log_std, LOG_STD_MIN, LOG_STD_MAX)
+        act_dist = tfd.Independent(tfd.Normal(mean, tf.exp(log_std)), reinterpreted_batch_ndims=1)
         if self.action_range is not None:
-            act_dist = (
-                self.tfp.distributions.TransformedDistribution(
-                    distribution=act_dist,
-                    bijector=self.tfb.Chain(
-                        [self.tfb.Affine(scale_identity_multiplier=self.action_range),
-                         self.tfb.Tanh()])
-                ))
+            act_dist = tfd.TransformedDistribution(
+                distribution=act_dist,
+                bijector=tfb.Chain([tfb.Scale(self.action_range), tfb.Tanh()]))
         return act_dist
 
-    @tf.function
+    def _logits2action(self, logits):
+        if self.deterministic_policy:
+            mean, _ = tf.split(logits, num_or_size_splits=2, axis=-1)
+            return self.action_range * tf.tanh(mean) if self.action_range is not None else mean, 0.
+        else:
+            act_dist = self._logits2dist(logits)
+            actions = act_dist.sample()
+            logps = act_dist.log_prob(actions)
+            return actions, logps
+
     def compute_action(self, obs):
-        with self.tf.name_scope('compute_action') as scope:
-            logits = self.policy(obs)
-            if self.deterministic_policy:
-                mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-                return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean, 0.
-            else:
-                act_dist = self._logits2dist(logits)
-                actions = act_dist.sample()
-                logps = act_dist.log_prob(actions)
-                return actions, logps
+        with tf.name_scope('compute_action') as scope:
+            return self._logits2action(self.policy(obs))
 
-    @tf.function
     def compute_target_action(self, obs):
-        with self.tf.name_scope('compute_target_action') as scope:
-            logits = self.policy_target(obs)
-            if self.deterministic_policy:
-                mean, _ = self.tf.split(logits, num_or_size_splits=2, axis=-1)
-                return self.action_range * self.tf.tanh(mean) if self.action_range is not None else mean, 0.
-            else:
-                act_dist = self._logits2dist(logits)
-                actions = act_dist.sample()
-                logps = act_dist.log_prob(actions)
-                return actions, logps
+        with tf.name_scope('compute_target_action') as scope:
+            return self._logits2action(self.policy_target(obs))
 
-    @tf.function
     def compute_Q1(self, obs, act):
-        with self.tf.name_scope('compute_Q1') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q1') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q1(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q2(self, obs, act):
-        with self.tf.name_scope('compute_Q2') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q2') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q2(Q_inputs), axis=1)
 
-    @tf.function
     def compute_QC1(self, obs, act):
-        with self.tf.name_scope('compute_QC1') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_QC1') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.QC1(Q_inputs), axis=1)
 
-    @tf.function
     def compute_QC2(self, obs, act):
-        with self.tf.name_scope('compute_QC2') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_QC2') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.QC2(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q1_target(self, obs, act):
-        with self.tf.name_scope('compute_Q1_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q1_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q1_target(Q_inputs), axis=1)
 
-    @tf.function
     def compute_Q2_target(self, obs, act):
-        with self.tf.name_scope('compute_Q2_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_Q2_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.Q2_target(Q_inputs), axis=1)
 
-    @tf.function
     def compute_QC1_target(self, obs, act):
-        with self.tf.name_scope('compute_QC1_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_QC1_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.QC1_target(Q_inputs), axis=1)
 
-    @tf.function
     def compute_QC2_target(self, obs, act):
-        with self.tf.name_scope('compute_QC2_target') as scope:
-            Q_inputs = self.tf.concat([obs, act], axis=-1)
+        with tf.name_scope('compute_QC2_target') as scope:
+            Q_inputs = tf.concat([obs, act], axis=-1)
             return tf.squeeze(self.QC2_target(Q_inputs), axis=1)
 
-    @tf.function
     def compute_lam(self, obs):
-        with self.tf.name_scope('compute_lam') as scope:
-            # Q_inputs = self.tf.concat([obs], axis=-1)
+        with tf.name_scope('compute_lam') as scope:
+            # Q_inputs = tf.concat([obs], axis=-1)
             return tf.squeeze(self.Lam(obs), axis=1)
 
+    def compute_Qs(self, obs, act):
+        with tf.name_scope('compute_Qs') as scope:
+            return tf.squeeze(ensemble_forward(self.Qs, obs, act), axis=-1)
+
+    def compute_Q_targets(self, obs, act):
+        with tf.name_scope('compute_Q_targets') as scope:
+            return tf.squeeze(ensemble_forward(self.Q_targets, obs, act), axis=-1)
+
     @property
     def log_alpha(self):
         return self.alpha_model.log_alpha
@@ -601,44 +618,34 @@ class PolicyWithAdaSafetyIndex(PolicyWithMu):
         k_lr_schedule = kwargs.get('k_lr_schedule')
         k_lr = PolynomialDecay(*k_lr_schedule)
         self.sis_para = SiSParaModel(name='k', init_var=self.init_sis_paras)
-        self.k_optimizer = self.tf.keras.optimizers.Adam(k_lr, name='k_opt')
+        self.k_optimizer = tf.keras.optimizers.Adam(k_lr, name='k_opt')
         self.adaptive_safety_index = kwargs.get('adaptive_safety_index')
         self.models += (self.sis_para,)
         self.optimizers += (self.k_optimizer,)
+        self._grad_layout.append((self.sis_para.name, self.k_optimizer, self.sis_para.trainable_weights))
+        self._grad_slices = build_grad_slices(self._grad_layout)
+        self._flat_weights = tuple(weight for model in self.models + self.target_models for weight in model.weights)
+        self._ckpt = self._build_ckpt()
         self.adaptive_si_interval = kwargs.get('adaptive_si_interval')
         self.adaptive_si_start = kwargs.get('adaptive_si_start')
 
     @tf.function
     def apply_gradients(self, iteration, grads):
         assert self.double_Q
-        q_weights_len = len(self.Q1.trainable_weights)
-        policy_weights_len = len(self.policy.trainable_weights)
-        lam_weights_len = len(self.Lam.trainable_weights)
-        q1_grad, q2_grad, qc1_grad, qc2_grad, policy_grad = \
-            grads[:q_weights_len], \
-            grads[q_weights_len:2 * q_weights_len], \
-            grads[2 * q_weights_len:3 * q_weights_len], \
-            grads[3 * q_weights_len:4 * q_weights_len], \
-            grads[4 * q_weights_len:4 * q_weights_len + policy_weights_len]
-        self.Q1_optimizer.apply_gradients(zip(q1_grad, self.Q1.trainable_weights))
-        self.Q2_optimizer.apply_gradients(zip(q2_grad, self.Q2.trainable_weights))
-        self.QC1_optimizer.apply_gradients(zip(qc1_grad, self.QC1.trainable_weights))
+        self._apply_grads('Q1', grads)
+        self._apply_grads('Q2', grads)
+        self._apply_grads('QC1', grads)
         if self.double_QC:
-            self.QC2_optimizer.apply_gradients(zip(qc2_grad, self.QC2.trainable_weights))
+            self._apply_grads('QC2', grads)
         if iteration % self.dual_ascent_interval == 0:
-            lam_grad = grads[
-                       4 * q_weights_len + policy_weights_len: 4 * q_weights_len + policy_weights_len + lam_weights_len]
-            self.Lam_optimizer.apply_gradients(zip(lam_grad, self.Lam.trainable_weights))
+            self._apply_grads('Lam', grads)
         if iteration % self.delay_update == 0:
-            self.policy_optimizer.apply_gradients(zip(policy_grad, self.policy.trainable_weights))
-            self.update_policy_target()
-            self.update_all_Q_target()
-            alpha_grad = grads[-2:-1]
-            self.alpha_optimizer.apply_gradients(zip(alpha_grad, self.alpha_model.trainable_weights))
+            self._apply_grads('policy', grads)
+            self.update_targets()
+            self._apply_grads('alpha', grads)
         if self.adaptive_safety_index:
             if iteration % self.adaptive_si_interval == 0 and iteration > self.adaptive_si_start:
-                k_grad = grads[-1:]
-                self.k_optimizer.apply_gradients(zip(k_grad, self.sis_para.trainable_weights))
+                self._apply_grads('k', grads)
 
     @property
     def get_sis_paras(self):
@@ -58,11 +58,27 @@ NUM_WORKER = 12
 NUM_LEARNER = 6
 NUM_BUFFER = 6
 
+
+def _json_list(s):
+    # e.g. --obs_scale "[1.0, 1.0, 0.5]"; argparse's type=list would split the string into characters
+    value = json.loads(s)
+    if not isinstance(value, list):
+        raise argparse.ArgumentTypeError('expected a JSON list, got {}'.format(s))
+    return value
+
+
+def _lr_schedule(s):
+    # [initial_lr, decay_steps, end_lr] as passed to PolynomialDecay
+    value = _json_list(s)
+    if len(value) != 3:
+        raise argparse.ArgumentTypeError('expected [initial_lr, decay_steps, end_lr], got {}'.format(s))
+    return [float(value[0]), int(value[1]), float(value[2])]
+
 def built_FSAC_parser(alg_name):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--mode', type=str, default='training') # training testing
-    mode = parser.parse_args().mode
+    mode = parser.parse_known_args()[0].mode
 
     if mode == 'testing':
         test_dir = '../results/FSAC-A/Unicycle/data2plot2/Unicycle-2021-08-09-23-22-26'
@@ -113,7 +129,7 @@ def built_FSAC_parser(alg_name):
     parser.add_argument('--adaptive_safety_index', type=bool, default=True)
     parser.add_argument('--adaptive_si_start', type=int, default=100000)
     parser.add_argument('--adaptive_si_interval', type=int, default=24)
-    parser.add_argument('--init_sis_paras', type=list, default=[0.3, 1.0, 1.0]) # # margin, k, power
+    parser.add_argument('--init_sis_paras', type=_json_list, default=[0.3, 1.0, 1.0]) # # margin, k, power
 
     # worker
     parser.add_argument('--batch_size', type=int, default=128)
@@ -133,7 +149,6 @@ def built_FSAC_parser(alg_name):
     parser.add_argument('--eval_log_interval', type=int, default=1)
     parser.add_argument('--fixed_steps', type=int, default=None)
     parser.add_argument('--eval_render', type=bool, default=False)
-    num_eval_episode = parser.parse_args().num_eval_episode
     parser.add_argument('--num_eval_agent', type=int, default=1)
 
     # policy and model
@@ -143,21 +158,21 @@ def built_FSAC_parser(alg_name):
     parser.add_argument('--value_num_hidden_layers', type=int, default=2)
     parser.add_argument('--value_num_hidden_units', type=int, default=256)
     parser.add_argument('--value_hidden_activation', type=str, default='elu')
-    parser.add_argument('--value_lr_schedule', type=list, default=[8e-5, 2000000, 1e-6])
-    parser.add_argument('--cost_value_lr_schedule', type=list, default=[8e-5, 2000000, 1e-6])
+    parser.add_argument('--value_lr_schedule', type=_lr_schedule, default=[8e-5, 2000000, 1e-6])
+    parser.add_argument('--cost_value_lr_schedule', type=_lr_schedule, default=[8e-5, 2000000, 1e-6])
     parser.add_argument('--policy_model_cls', type=str, default='MLP')
     parser.add_argument('--policy_num_hidden_layers', type=int, default=2)
     parser.add_argument('--policy_num_hidden_units', type=int, default=256)
     parser.add_argument('--policy_hidden_activation', type=str, default='elu')
     parser.add_argument('--policy_out_activation', type=str, default='linear')
-    parser.add_argument('--policy_lr_schedule', type=list, default=[3e-5, 1000000, 1e-6])
-    parser.add_argument('--lam_lr_schedule', type=list, default=[5e-6, 150000, 1e-6])
+    parser.add_argument('--policy_lr_schedule', type=_lr_schedule, default=[3e-5, 1000000, 1e-6])
+    parser.add_argument('--lam_lr_schedule', type=_lr_schedule, default=[5e-6, 150000, 1e-6])
     parser.add_argument('--alpha', default='auto')  # 'auto' 0.02
-    alpha = parser.parse_args().alpha
+    alpha = parser.parse_known_args()[0].alpha
     if alpha == 'auto':
         parser.add_argument('--target_entropy', type=float, default=-2)
-    parser.add_argument('--alpha_lr_schedule', type=list, default=[8e-5, 1000000, 8e-6])
-    parser.add_argument('--k_lr_schedule', type=list, default=[8e-6, 100000, 1e-6])
+    parser.add_argument('--alpha_lr_schedule', type=_lr_schedule, default=[8e-5, 1000000, 8e-6])
+    parser.add_argument('--k_lr_schedule', type=_lr_schedule, default=[8e-6, 100000, 1e-6])
     parser.add_argument('--policy_only', type=bool, default=False)
     parser.add_argument('--double_Q', type=bool, default=True)
     parser.add_argument('--target', type=bool, default=True)
@@ -165,15 +180,16 @@ def built_FSAC_parser(alg_name):
     parser.add_argument('--delay_update', type=int, default=2)
     parser.add_argument('--dual_ascent_interval', type=int, default=12)
     parser.add_argument('--deterministic_policy', type=bool, default=False)
+    parser.add_argument('--jit_compile', action='store_true')  # XLA-compile the Q, mode, lam and target-update functions
+    parser.add_argument('--dtype_policy', type=str, default='float32', choices=['float32', 'mixed_bfloat16'],
+                        help='precision of the MLP hidden layers; GPUs are hidden from every process, so bf16 runs on CPU')
     parser.add_argument('--action_range', type=float, default=1.0)
     parser.add_argument('--mu_bias', type=float, default=0.0)
-    cost_lim = parser.parse_args().cost_lim
     parser.add_argument('--cost_bias', type=float, default=0.0)
 
     # preprocessor
     parser.add_argument('--obs_ptype', type=str, default='scale')
-    num_future_data = parser.parse_args().num_future_data
-    parser.add_argument('--obs_scale', type=list, default=[1.0, 1.0, 1.0, 1 / 3.14, 1 / 3.0])
+    parser.add_argument('--obs_scale', type=_json_list, default=[1.0, 1.0, 1.0, 1 / 3.14, 1 / 3.0])
     parser.add_argument('--rew_ptype', type=str, default='scale')
     parser.add_argument('--rew_scale', type=float, default=1.)
     parser.add_argument('--rew_shift', type=float, default=0.)
@@ -184,6 +200,7 @@ def built_FSAC_parser(alg_name):
     parser.add_argument('--num_workers', type=int, default=NUM_WORKER)
     parser.add_argument('--num_learners', type=int, default=NUM_LEARNER)
     parser.add_argument('--num_buffers', type=int, default=NUM_BUFFER)
+    parser.add_argument('--object_store_memory', type=int, default=None)  # bytes, None lets ray decide
     parser.add_argument('--max_weight_sync_delay', type=int, default=300)
     parser.add_argument('--grads_queue_size', type=int, default=25)
     parser.add_argument('--grads_max_reuse', type=int, default=0)
@@ -193,9 +210,9 @@ def built_FSAC_parser(alg_name):
 
     # IO
     time_now = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    env_id = parser.parse_args().env_id
+    env_id = parser.parse_known_args()[0].env_id
     task = env_id.split('-')[1] if env_id.startswith('Safexp') else env_id.split('-')[0]
-    alg_name = parser.parse_args().alg_name
+    alg_name = parser.parse_known_args()[0].alg_name
     results_dir = '../results/{alg}/{task}/{experiment}-{time}'.format(task=task,
                                                                        alg=alg_name,
                                                                       experiment=task,
@@ -235,7 +252,10 @@ def main(alg_name):
     args = built_parser(alg_name)
     logger.info('begin training agents with parameter {}'.format(str(args)))
     if args.mode == 'training':
-        ray.init()
+        # one cpu per worker, learner and buffer actor plus the evaluator, so every actor
+        # gets scheduled even on machines with fewer cores than actors
+        ray.init(num_cpus=args.num_workers + args.num_learners + args.num_buffers + 1,
+                 object_store_memory=args.object_store_memory)
         os.makedirs(args.result_dir)
         with open(args.result_dir + '/config.json', 'w', encoding='utf-8') as f:
             json.dump(vars(args), f, ensure_ascii=False, indent=4)
@@ -101,7 +101,8 @@ class OffPolicyWorker(object):
         for _ in range(int(self.batch_size/self.num_agent)):
             processed_obs = self.preprocessor.process_obs(self.obs)
             judge_is_nan([processed_obs])
-            action, logp = self.policy_with_value.compute_action(self.tf.constant(processed_obs))
+            action, logp = self.policy_with_value.compute_action(self.tf.constant(processed_obs, dtype=self.tf.float32))
+            action = action.numpy()
             if self.explore_sigma is not None:
                 action += np.random.normal(0, self.explore_sigma, np.shape(action))
             try:
@@ -110,13 +111,13 @@ class OffPolicyWorker(object):
                 print('processed_obs', processed_obs)
                 print('preprocessor_params', self.preprocessor.get_params())
                 print('policy_weights', self.policy_with_value.policy.trainable_weights)
-                action, logp = self.policy_with_value.compute_action(processed_obs)
+                action, logp = self.policy_with_value.compute_action(processed_obs.astype(np.float32))
                 judge_is_nan([action])
                 raise ValueError
-            obs_tp1, reward, self.done, info = self.env.step(action.numpy())
+            obs_tp1, reward, self.done, info = self.env.step(action)
             processed_rew = self.preprocessor.process_rew(reward, self.done)
             for i in range(self.num_agent):
-                batch_data.append((self.obs[i].copy(), action[i].numpy(), reward[i], obs_tp1[i].copy(), self.done[i]))
+                batch_data.append((self.obs[i].copy(), action[i].copy(), reward[i], obs_tp1[i].copy(), self.done[i]))
             self.obs = self.env.reset()
 
         if self.worker_id == 1 and self.sample_times % self.args.worker_log_interval == 0:
@@ -216,7 +217,8 @@ class OffPolicyWorkerWithCost(object):
         for _ in range(int(self.batch_size/self.num_agent)):
             processed_obs = self.preprocessor.process_obs(self.obs)
             judge_is_nan([processed_obs])
-            action, logp = self.policy_with_value.compute_action(self.tf.constant(processed_obs))
+            action, logp = self.policy_with_value.compute_action(self.tf.constant(processed_obs, dtype=self.tf.float32))
+            action = action.numpy()
             if self.explore_sigma is not None:
                 action += np.random.normal(0, self.explore_sigma, np.shape(action))
             try:
@@ -225,10 +227,10 @@ class OffPolicyWorkerWithCost(object):
                 print('processed_obs', processed_obs)
                 print('preprocessor_params', self.preprocessor.get_params())
                 print('policy_weights', self.policy_with_value.policy.trainable_weights)
-                action, logp = self.policy_with_value.compute_action(processed_obs)
+                action, logp = self.policy_with_value.compute_action(processed_obs.astype(np.float32))
                 judge_is_nan([action])
                 raise ValueError
-            obs_tp1, reward, self.done, info = self.env.step(action.numpy())
+            obs_tp1, reward, self.done, info = self.env.step(action)
             real_cost = info[0].get('cost', 0)
             self.sampled_costs += real_cost
             cost = info[0].get('delta_phi', 0)
@@ -237,7 +239,7 @@ class OffPolicyWorkerWithCost(object):
             sis_info = info[0].get('sis_trans')
             processed_rew = self.preprocessor.process_rew(reward, self.done)
             for i in range(self.num_agent):
-                batch_data.append((self.obs[i].copy(), action[i].numpy(), reward[i], obs_tp1[i].copy(), self.done[i],
+                batch_data.append((self.obs[i].copy(), action[i].copy(), reward[i], obs_tp1[i].copy(), self.done[i],
                                    cost, sis_info))
             self.obs = self.env.reset()
 
@@ -265,7 +267,7 @@ class OffPolicyWorkerWithCost(object):
                 print('processed_obs', processed_obs)
                 print('preprocessor_params', self.preprocessor.get_params())
                 print('policy_weights', self.policy_with_value.policy.trainable_weights)
-                action, logp = self.policy_with_value.compute_action(processed_obs)
+                action, logp = self.policy_with_value.compute_action(processed_obs.astype(np.float32))
                 judge_is_nan([action])
                 raise ValueError
             obs_tp1, reward, self.done, info = self.env.step(action)